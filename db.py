@@ -19,26 +19,38 @@ Example usage:
 >>> class MySQLite(SQLite): pass
 >>> with MySQLite('.') as data: 
 ...     procedures_with_database(data)
-('game1', 'germany')
 ('game2', 'italy')
 >>> class MyBerkeley(Berkeley): pass
 >>> with MyBerkeley('.') as data:
 ...     procedures_with_database(data)
 '''
+import contextlib
+import functools
+import importlib
 import os
+import re
 import syslog
+import urllib.parse
+
+_IDENT_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]{0,63}$')
+
+def _check_identifier(name):
+    '''Raises ValueError unless name is safe to put into SQL as table or column name.'''
+    if not _IDENT_RE.match(name):
+        raise ValueError('Invalid identifier: {0!r}'.format(name))
+    return name
 
 def verify(db_file):
     '''Verifies database file.'''
-    data = db.DB()
+    data = importlib.import_module('bsddb3.db').DB()
     data.verify(db_file)
 
 def removeEnv(home_folder):
     '''Removes environment created.'''
-    env_files = os.listdir(home_folder)
-    for db_file in env_files:
-        if db_file[0:2] == '__':
-            os.remove(os.path.join(home_folder,db_file))
+    with os.scandir(home_folder) as env_files:
+        for db_file in env_files:
+            if db_file.name.startswith('__'):
+                os.remove(db_file.path)
 
 
 class Data():
@@ -58,16 +70,17 @@ class Data():
         pass
 
     def put(self,name,key,data,**indexes):
-        self.assert_exist(name)
         self.tables[name].put(key,data,**indexes)
 
+    def put_many(self,name,items):
+        '''items - iterable of (key, data) pairs'''
+        self.tables[name].put_many(items)
+
     def get(self,name,key):
-        self.assert_exist(name)
         value = self.tables[name].get(key)
         return value
 
     def delete(self,name,key):
-        self.assert_exist(name)
         key = str(key).encode()
         self.tables[name].delete(key)
 
@@ -75,7 +88,7 @@ class Data():
         self.tables[name].verify(name+'.db')
 
     def table(self,name,**key):
-        self.assert_exist(name)
+        self.ensure_table(name)
         if not key:
             return self.tables[name]
         table = self.tables[name]
@@ -85,68 +98,104 @@ class Data():
         new_table = db_obj
         self.tables[name] = new_table
 
-    def assert_exist(self,table):
-        if not table in self.tables:
-            self.open(table)
+    def ensure_table(self,name):
+        '''Opens table if it is not open yet and returns it.
+        put, get and delete expect table to be opened beforehand.
+        '''
+        if name not in self.tables:
+            self.open(name)
+        return self.tables[name]
+
+class CursorPool():
+    '''Helper class reusing Berkeley DB cursors between iterations.
+    Cursors are pooled only when pool_cursors is set: in environment with locking
+    a parked cursor keeps read lock on its page and would block writes to it.
+    '''
+
+    def _take_cursor(self):
+        if self._cursor_pool:
+            return self._cursor_pool.pop()
+        return self.db.cursor()
+
+    def _release_cursor(self,cursor):
+        if self.pool_cursors:
+            self._cursor_pool.append(cursor)
+        else:
+            cursor.close()
+
 
-class Index():
+class Index(CursorPool):
     '''Helper class for Berkeley DB index instances.'''
 
+    def __init__(self,db_obj,db_mod,pool_cursors=False):
+        self.db = db_obj
+        self._GET_BOTH_RANGE = db_mod.DB_GET_BOTH_RANGE
+        self._CURRENT = db_mod.DB_CURRENT
+        self.cursor = False
+        self.pool_cursors = pool_cursors
+        self._cursor_pool = []
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if not self.cursor: 
-            self.cursor = self.db.cursor()
-            item = self.cursor.pget(self.cursor_value.encode(),db.DB_GET_BOTH_RANGE)
+        cursor = self.cursor
+        if not cursor: 
+            cursor = self.cursor = self._take_cursor()
+            item = cursor.pget(self.cursor_value.encode(),self._GET_BOTH_RANGE)
         else:
-            if self.cursor.next_dup():
-                item = self.cursor.pget(db.DB_CURRENT)
+            if cursor.next_dup():
+                item = cursor.pget(self._CURRENT)
             else:
                 item = None
         if not item:
-            self.cursor.close()
+            self._release_cursor(cursor)
             self.cursor = False
             raise StopIteration
         i_key, key, value = item
         return key.decode(), value.decode()
 
     def __len__(self):
-        if not self.cursor: self.cursor = self.db.cursor()
-        a = 0
-        while self.cursor.next():
-            a += 1
-        self.cursor.close()
-        self.cursor = False
-        return a
+        return self.db.stat()['ndata']
 
 
-class Table():
+class Table(CursorPool):
 
     def __init__(self,name):
         self.name = name
         self.cursor = False
         self.indexes = {}
+        '''raw - iterate over bytes as stored, without decoding'''
+        self.raw = False
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if not self.cursor: self.cursor = self.db.cursor()
-        item = self.cursor.next()
+        if not self.cursor:
+            '''Cursor returned to the pool is left at the end, so start over from first record'''
+            self.cursor = self._take_cursor()
+            item = self.cursor.first()
+        else:
+            item = self.cursor.next()
         if not item:
-            self.cursor.close()
+            self._release_cursor(self.cursor)
             self.cursor = False
             raise StopIteration
+        if self.raw:
+            return item
         key, value = item
         return key.decode(), value.decode()
 
     def put(self,key,data):
-        print('Put method must be defined!')
+        raise NotImplementedError('subclass must override put()')
+
+    def put_many(self,items):
+        for key, data in items:
+            self.put(key,data)
 
     def get(self,key):
-        print('Get method must be defined!')
+        raise NotImplementedError('subclass must override get()')
 
     def delete(self,key):
         return self.db.delete(key)
@@ -164,30 +213,43 @@ class Berkeley(Data):
     thread_safe - allows multiple posts and reads from threads
     '''
     def __init__(self,path,thread_safe=True):
-        global db
-        from bsddb3 import db
+        self._db_mod = db = importlib.import_module('bsddb3.db')
         Data.__init__(self, path)
+        self.indexes = {}
+        '''Without locking parked cursors hold no page locks, so they are safe to reuse'''
+        self._pool_cursors = not thread_safe
         self.env = db.DBEnv()
         if not thread_safe:
             DB_THREAD = 0
+            DB_INIT_LOCK = 0
         else:
             DB_THREAD = db.DB_THREAD
-        flags = db.DB_CREATE + db.DB_INIT_MPOOL + DB_THREAD
+            DB_INIT_LOCK = db.DB_INIT_LOCK
+            '''Room for cursors opened from many threads, so they do not fight over the shared env mutex.
+            Deadlocks between lockers are broken with DB_LOCK_DEADLOCK instead of hanging.
+            '''
+            self.env.mutex_set_increment(1024)
+            self.env.set_lk_max_lockers(2000)
+            self.env.set_lk_max_locks(10000)
+            self.env.set_lk_max_objects(10000)
+            self.env.set_lk_detect(db.DB_LOCK_DEFAULT)
+        flags = db.DB_CREATE + db.DB_INIT_MPOOL + DB_INIT_LOCK + DB_THREAD
         self.env.open(path, flags)
 
     def __exit__(self,exc_type, exc_value, traceback):
         self.close()
 
     def table(self,name,**key):
-        self.assert_exist(name)
+        self.ensure_table(name)
         if not key:
             return self.tables[name]
+        if len(key) > 1:
+            raise ValueError('Only one index can be queried at a time, got: {0}'.format(', '.join(key)))
         table = self.tables[name]
-        while key:
-            k, v = key.popitem()
-            index_obj = getattr(table, k)
-            setattr(index_obj, 'cursor_value', v)
-            return index_obj
+        (k, v), = key.items()
+        index_obj = table.indexes[k]
+        index_obj.cursor_value = v
+        return index_obj
 
     def add_index(self,index,index_callback,table):
         '''adds index to table, can be as many as one likes
@@ -195,128 +257,296 @@ class Berkeley(Data):
         '''
         if index in self.tables:
             raise 'Index name shall not be the same as table name itself'
-        setattr(self, index, Index())
-        instance = getattr(self, index)
-        setattr(instance,'db',db.DB(self.env))
-        getattr(instance,'db').set_flags(db.DB_DUPSORT)
-        getattr(instance,'db').open(table + '_idx_' + index + '.db', db.DB_BTREE, db.DB_CREATE)
-        setattr(instance, 'cursor', False)
-        print(instance)
-        print(getattr(instance, 'db'))
-        self.db.associate(getattr(instance,'db'),index_callback)
-        self.indexes.append(instance)
+        primary = self.ensure_table(table)
+        db = self._db_mod
+        instance = Index(db.DB(self.env), db, self._pool_cursors)
+        instance.db.set_flags(db.DB_DUPSORT)
+        instance.db.open(table + '_idx_' + index + '.db', db.DB_BTREE, db.DB_CREATE)
+        primary.db.associate(instance.db, index_callback)
+        primary.indexes[index] = instance
+        self.indexes[table + '_idx_' + index] = instance
 
     def open(self,name):
+        db = self._db_mod
         db_obj = db.DB(self.env)
         db_obj.open(name + '.db', db.DB_BTREE, db.DB_CREATE)
-        new_table = BSDTable(name, db_obj)
+        new_table = BSDTable(name, db_obj, self._pool_cursors)
         Data.open(self, name, new_table)
 
     def close(self):
-        for index in self.indexes:
-            cursor = getattr(index, 'cursor')
-            if cursor:
+        for index in self.indexes.values():
+            if index.cursor:
+                index.cursor.close()
+            for cursor in index._cursor_pool:
                 cursor.close()
-            db = getattr(index, 'db')
-            db.close()
+            index.db.close()
         for table in self.tables.values():
             if table.cursor:
                 table.cursor.close()
+            for cursor in table._cursor_pool:
+                cursor.close()
             table.close()
         self.env.close()
 
 class BSDTable(Table):
 
 
-    def __init__(self, name, db_obj):
+    def __init__(self, name, db_obj, pool_cursors=False):
         self.db = db_obj
         Table.__init__(self, name)
+        self.pool_cursors = pool_cursors
+        self._cursor_pool = []
 
     def put(self,key,data):
         k,v = key.encode(), data.encode()
         self.db.put(k, v)
 
+    def put_many(self,items):
+        put = self.db.put
+        for key, data in items:
+            put(key.encode(), data.encode())
+
+    def put_bytes(self,key,data):
+        '''Stores already encoded key and data as they are'''
+        self.db.put(key, data)
+
+    def get_bytes(self,key):
+        return self.db.get(key)
+
+    def drain_batch(self,n):
+        '''Returns up to n next (key, value) byte pairs, continuing table iteration.
+        Empty list means end of table.
+        '''
+        if n < 1:
+            raise ValueError('Batch size must be at least 1, got: {0}'.format(n))
+        if not self.cursor:
+            self.cursor = self._take_cursor()
+            item = self.cursor.first()
+        else:
+            item = self.cursor.next()
+        batch = []
+        append, next_item = batch.append, self.cursor.next
+        while item:
+            append(item)
+            if len(batch) == n:
+                return batch
+            item = next_item()
+        self._release_cursor(self.cursor)
+        self.cursor = False
+        return batch
+
+    def scan_arrays(self,cap=65536,key_size=32,value_size=128):
+        '''Reads up to cap records from start of table into two NumPy arrays of fixed width bytes.
+        Keys and values longer than key_size and value_size are truncated.
+        '''
+        import numpy as np
+        keys = np.empty(cap, dtype='S{0}'.format(key_size))
+        values = np.empty(cap, dtype='S{0}'.format(value_size))
+        cursor = self._take_cursor()
+        item = cursor.first()
+        n = 0
+        while item and n < cap:
+            keys[n], values[n] = item
+            n += 1
+            item = cursor.next()
+        self._release_cursor(cursor)
+        return keys[:n], values[:n]
+
     def get(self,key):
         data = self.db.get(key.encode())
         return data.decode() 
 
+    def __len__(self):
+        return self.db.stat()['ndata']
+
     def close(self):
         self.db.close()
 
 #SQLite3 classes
 class SQLite(Data):
-    '''Class to access SQLite database''' 
+    '''Class to access SQLite database
+    vfs - name of SQLite VFS to open database with, e.g. an io_uring backed one on Linux
+    vfs_extension - path to SQLite loadable extension that registers the vfs
+    ''' 
 
-    def __init__(self,path,filename='data'):
-        global sqlite3
+    def __init__(self,path,filename='data',vfs=None,vfs_extension=None):
         import sqlite3
         Data.__init__(self, path)
-        self.db = sqlite3.connect(path + filename)
+        self._vfs_loader = None
+        self._tx_depth = 0
+        try:
+            if vfs_extension:
+                '''Extension stays loaded only while connection that loaded it is open'''
+                self._vfs_loader = sqlite3.connect(':memory:')
+                if not hasattr(self._vfs_loader, 'enable_load_extension'):
+                    raise sqlite3.NotSupportedError(
+                        'Python sqlite3 is built without extension loading, cannot load {0}'.format(vfs_extension))
+                self._vfs_loader.enable_load_extension(True)
+                self._vfs_loader.load_extension(vfs_extension)
+            if vfs:
+                uri = 'file:{0}?vfs={1}'.format(urllib.parse.quote(path + filename), urllib.parse.quote(vfs))
+                self.db = sqlite3.connect(uri, uri=True)
+            else:
+                self.db = sqlite3.connect(path + filename)
+        except BaseException:
+            if self._vfs_loader:
+                self._vfs_loader.close()
+            raise
         self.cur = self.db.cursor()
+        self.cur.execute("PRAGMA journal_mode=WAL")
+        self.cur.execute("PRAGMA synchronous=NORMAL")
+        self.cur.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+        self.cur.execute("PRAGMA temp_store=MEMORY")
+        self.cur.execute("PRAGMA cache_size=-65536")    # 64 MiB page cache
 
     def __exit__(self,exc_type, exc_value, traceback):
         self.db.commit()
         self.db.close()
+        if self._vfs_loader:
+            self._vfs_loader.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Groups writes into one transaction, committed on success and rolled back on error.
+        Writes made before it are committed first, so an error does not roll them back.
+        Nested blocks use savepoints, error in inner block rolls back only its own writes.
+
+        >>> import tempfile
+        >>> with SQLite(tempfile.mkdtemp() + '/') as data:
+        ...     data.open('games')
+        ...     data.put('games','game1','germany')
+        ...     try:
+        ...         with data.transaction():
+        ...             data.put('games','game2','italy')
+        ...             raise KeyError('game2')
+        ...     except KeyError:
+        ...         pass
+        ...     with data.transaction():
+        ...         data.put('games','game3','usa')
+        ...         try:
+        ...             with data.transaction():
+        ...                 data.put('games','game4','spain')
+        ...                 raise KeyError('game4')
+        ...         except KeyError:
+        ...             pass
+        ...     print(sorted(data.table('games')))
+        [('game1', 'germany'), ('game3', 'usa')]
+        '''
+        depth = self._tx_depth
+        if not depth:
+            self.db.commit()
+            self.db.execute("BEGIN")
+        else:
+            self.db.execute("SAVEPOINT tx{0}".format(depth))
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            if not depth:
+                self.db.rollback()
+            else:
+                self.db.execute("ROLLBACK TO tx{0}".format(depth))
+                self.db.execute("RELEASE tx{0}".format(depth))
+            raise
+        else:
+            if not depth:
+                self.db.commit()
+            else:
+                self.db.execute("RELEASE tx{0}".format(depth))
+        finally:
+            self._tx_depth -= 1
 
     def open(self,name):
+        _check_identifier(name)
         if not self.cur.execute('''SELECT * FROM sqlite_master WHERE type='table' AND name=?''', (name,)).fetchone():
-            stmt = "CREATE TABLE {0} (key text, value text)".format(name)
+            stmt = "CREATE TABLE {0} (key text PRIMARY KEY, value text)".format(name)
+            self.cur.execute(stmt)
+        elif not self._has_unique_key(name):
+            '''Tables created before key was PRIMARY KEY need unique index for upsert in put'''
+            stmt = "DELETE FROM {0} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {0} GROUP BY key);".format(name)
+            self.cur.execute(stmt)
+            stmt = "CREATE UNIQUE INDEX IF NOT EXISTS {0}_key ON {0}(key);".format(name)
             self.cur.execute(stmt)
-            self.db.commit()
         new_table = SQLTable(name, self.cur, self.db)
         Data.open(self, name, new_table)
 
+    def _has_unique_key(self,name):
+        '''Tells if key column of table is covered by PRIMARY KEY or UNIQUE index on its own'''
+        stmt = "PRAGMA index_list({0})".format(name)
+        for idx in self.cur.execute(stmt).fetchall():
+            if not idx[2]:
+                continue
+            stmt = "PRAGMA index_info({0})".format(idx[1])
+            if [col[2] for col in self.cur.execute(stmt)] == ['key']:
+                return True
+        return False
+
     def table(self,name,**key):
-        self.assert_exist(name)
+        self.ensure_table(name)
         if not key:
             return self.tables[name]
-        table = self.tables[name]
-        while key:
-            k, v = key.popitem()
-            return SQLiteIndex(k,v,table)
+        if len(key) > 1:
+            raise ValueError('Only one index can be queried at a time, got: {0}'.format(', '.join(key)))
+        (k, v), = key.items()
+        return SQLiteIndex(k,v,self.tables[name])
 
 
 class SQLTable(Table):
 
     def __init__(self,name,db_cursor,db):
+        _check_identifier(name)
         Table.__init__(self,name)
         self.cur = db_cursor
         self.db = db
+        '''SQL is built once per table so sqlite3 statement cache is hit on every call'''
+        self._sql_get = "SELECT value FROM {0} WHERE key=?;".format(name)
+        self._sql_upsert = ("INSERT INTO {0} (key, value) VALUES (?,?) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value;").format(name)
+        self._do_upsert = functools.partial(self.cur.execute, self._sql_upsert)
+        self._buffer = []
+        self._buffer_idx = 0
+        self._sql_index_update = {}
+        self._sql_delete = "DELETE FROM {0} WHERE key=?;".format(name)
+        self._sql_iter = "SELECT key,value FROM {0};".format(name)
+        self._sql_count = "SELECT COUNT(*) FROM {0};".format(name)
     
     def __len__(self):
-        stmt = "SELECT COUNT(*) FROM {0};".format(self.name)
-        return self.cur.execute(stmt).fetchone()[0]
+        return self.cur.execute(self._sql_count).fetchone()[0]
 
     def __next__(self):
-        if not self.cursor:
-            stmt = "SELECT key,value FROM {0};".format(self.name)
-            self.cursor = self.cur.execute(stmt)
-        item = self.cursor.fetchone()
-        if not item:
-            self.cursor = False
-            raise StopIteration
-        key, value = item
+        if self._buffer_idx >= len(self._buffer):
+            if not self.cursor:
+                '''Own cursor, so statements run on shared one meanwhile do not reset iteration'''
+                self.cursor = self.db.execute(self._sql_iter)
+            self._buffer = self.cursor.fetchmany(1024)
+            self._buffer_idx = 0
+            if not self._buffer:
+                self.cursor = False
+                raise StopIteration
+        item = self._buffer[self._buffer_idx]
+        self._buffer_idx += 1
         return item
 
     def put(self,key,data,**indexes):
         key = str(key)
         data = str(data)
-        if not self.get(key):
-            self.sql_statement("INSERT",key,data,**indexes)
-        else:
-            self.sql_statement("UPDATE",key,data,**indexes)
+        self._do_upsert((key,data))
+        for index in indexes:
+            stmt = self._sql_index_update.get(index) or self._index_update_sql(index)
+            self.cur.execute(stmt, (indexes[index],key))
+
+    def put_many(self,items):
+        self.cur.executemany(self._sql_upsert, ((str(k), str(v)) for k, v in items))
 
     def get(self,key):
         key = str(key)
-        stmt = "SELECT value FROM {0} WHERE key=?;".format(self.name)
-        a = self.cur.execute(stmt, (key,)).fetchone()
+        a = self.cur.execute(self._sql_get, (key,)).fetchone()
         if a: 
             return a[0]
 
     def delete(self,key):
         key = str(key)
-        stmt = "DELETE FROM {0} WHERE key=?;".format(self.name)
-        self.cur.execute(stmt, (key,))
+        self.cur.execute(self._sql_delete, (key,))
 
     def add_index(self,index):
         '''adds index to table, can be as many as one likes
@@ -324,46 +554,38 @@ class SQLTable(Table):
         '''
         if index in self.__dict__['indexes']:
             raise 'Index already exists'
+        _check_identifier(index)
         stmt = "PRAGMA table_info({0})".format(self.name)
         col_list = self.cur.execute(stmt)
-        col = col_list.fetchone()
-        while col:
-            if col[1] == index: return
-            col = col_list.fetchone()
-            if not col: 
-                stmt = "ALTER TABLE {0} ADD COLUMN {1};".format(self.name,index)
-        self.cur.execute(stmt)
-        self.db.commit()
+        if index not in [col[1] for col in col_list]:
+            stmt = "ALTER TABLE {0} ADD COLUMN {1};".format(self.name,index)
+            self.cur.execute(stmt)
         self.__dict__['indexes'][index] = True
+        self._index_update_sql(index)
 
-    def sql_statement(self,mode,key,value,**indexes):
-        if mode == 'INSERT':
-            stmt = "INSERT INTO {0} (key, value) VALUES (?,?);".format(self.name)
-            self.cur.execute(stmt, (key,value))
-        elif mode == 'UPDATE':
-            stmt = "UPDATE {0} SET key=?, value=? WHERE key=?;".format(self.name)
-            self.cur.execute(stmt, (key,value,key))
-        if indexes:
-            for index in indexes:
-                '''Each index updates entry in a specific column'''
-                stmt = "UPDATE {0} SET {1}=? WHERE key=?;".format(self.name,index)
-                self.cur.execute(stmt, (indexes[index],key))
-        self.db.commit()
+    def _index_update_sql(self,index):
+        '''Each index updates entry in a specific column, statement is kept for put.
+        Column may come from add_index or exist already in reopened database.
+        '''
+        _check_identifier(index)
+        stmt = "UPDATE {0} SET {1}=? WHERE key=?;".format(self.name,index)
+        self._sql_index_update[index] = stmt
+        return stmt
 
 
 class SQLiteIndex(Index):
     
     
     def __init__(self,column,col_val,table):
-        self.column = column
+        self.column = _check_identifier(column)
         self.col_val = col_val
         self.table = table
         self.cursor = False
+        self._sql_select = "SELECT key, value FROM {0} WHERE {1}=?;".format(table.name,column)
     
     def __next__(self):
         if not self.cursor:
-            stmt = "SELECT key, value FROM {0} WHERE {1}={2};".format(self.table.name,self.column,self.col_val)
-            self.cursor = self.table.cur.execute(stmt)
+            self.cursor = self.table.db.execute(self._sql_select, (self.col_val,))
         item = self.cursor.fetchone()
         if not item:
             self.cursor = False